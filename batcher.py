@@ -0,0 +1,78 @@
+import logging
+import asyncio
+import orjson
+
+from utils import JSON_HEADERS
+
+
+class MicroBatcher:
+    """Collect /chat payloads and send them upstream in batches.
+
+    A batch is flushed once it holds max_batch_size items or max_wait_ms
+    has passed since its first item arrived. The batch endpoint must
+    accept {"items": [...]} and return {"items": [...]} in the same order.
+    """
+
+    def __init__(self, session, url, max_batch_size, max_wait_ms):
+        self.session = session
+        self.url = url
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._flushes = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def submit(self, payload):
+        """Queue a payload and wait for its response data, or None on an error status."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((payload, future))
+        return await future
+
+    async def _run_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Flush in the background so the next batch can start filling
+            flush = asyncio.create_task(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            body = orjson.dumps({"items": [payload for payload, _ in batch]})
+            async with self.session.post(self.url, data=body, headers=JSON_HEADERS) as response:
+                if response.status == 200:
+                    results = orjson.loads(await response.read())["items"]
+                    if len(results) != len(batch):
+                        raise ValueError(f"Expected {len(batch)} batch results, got {len(results)}")
+                else:
+                    results = [None] * len(batch)
+        except Exception as e:
+            logging.error(f"Batch request failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
\ No newline at end of file
@@ -9,13 +9,37 @@ if TG_BOT_API_KEY == "":
 API_HOST = os.getenv("API_HOST")
 if API_HOST is None:
     raise ValueError("API_HOST environment variable is not set")
+API_CHAT_URL = f"{API_HOST}/chat"
+API_CHAT_BATCH_URL = f"{API_HOST}/chat_batch"
+
+# Keep-alive server configuration
+PORT = int(os.getenv('PORT', 8080))
 
 # Redis configuration
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_DB = int(os.getenv('REDIS_DB', 0))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 3600))  # seconds
+LOCAL_CACHE_SIZE = int(os.getenv('LOCAL_CACHE_SIZE', 1024))  # answers kept in process
 
 # Request configuration
 MAX_RETRIES = 5
 INITIAL_RETRY_DELAY = 1
-API_TIMEOUT = 240  # seconds
\ No newline at end of file
+MAX_RETRY_DELAY = 30  # seconds
+API_TIMEOUT = 240  # seconds
+API_CONNECT_TIMEOUT = int(os.getenv('API_CONNECT_TIMEOUT', 5))  # seconds
+API_READ_TIMEOUT = int(os.getenv('API_READ_TIMEOUT', 60))  # seconds without data from the API
+API_CONCURRENCY = int(os.getenv('API_CONCURRENCY', 32))  # max in-flight API requests
+if API_CONCURRENCY < 1:
+    raise ValueError("API_CONCURRENCY must be at least 1")
+API_QUEUE_PER_WORKER = 8  # questions waiting per worker before new ones are refused
+API_BATCH_SIZE = int(os.getenv('API_BATCH_SIZE', 0))  # 0 disables batching via /chat_batch
+API_BATCH_WAIT_MS = int(os.getenv('API_BATCH_WAIT_MS', 10))
+
+# Telegram rate limits
+TELEGRAM_GLOBAL_RATE = 30  # messages per second across all chats
+TELEGRAM_CHAT_INTERVAL = 1.05  # seconds between messages to one chat
+
+# HTTP connection pool configuration
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 256))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 64))
\ No newline at end of file
@@ -1,18 +1,65 @@
+import html
 import logging
+import functools
 import asyncio
 import aiohttp
-from aiogram import types
+import orjson
+from dataclasses import dataclass
+from typing import Final
+from aiogram import F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.types import BotCommand
+from aiogram.exceptions import TelegramBadRequest
 
-from config import API_HOST, API_TIMEOUT
+from config import API_CHAT_URL, API_CONCURRENCY, API_QUEUE_PER_WORKER
 from states import UserStates
-from utils import safe_send_message, safe_delete_message, markdown_to_html
+from utils import (
+    safe_send_message, keep_typing, markdown_to_html,
+    get_cached_answer, cache_answer, drop_cached_answer, normalize_question, register_send_limiter,
+    JSON_HEADERS
+)
 
 
+_WELCOME_TEXT: Final[str] = (
+    "🌙 <b>Добро пожаловать в DinarAI!</b> 🌙\n\n"
+    "Я ваш персональный эксперт по исламским финансам, готовый помочь вам разобраться в:\n"
+    "• 🏦 Исламском банкинге\n"
+    "• 📊 Финансовых инструментах, соответствующих шариату\n"
+    "Просто задайте вопрос, и я предоставлю вам подробный ответ!.\n\n"
+    "<i>Ваш путь к этичным финансам начинается здесь!</i>"
+)
+_HELP_TEXT: Final[str] = (
+    "Я могу ответить на ваши вопросы об исламских финансах.\n\n"
+    "Просто напишите ваш вопрос, и я постараюсь помочь.\n\n"
+    "Доступные команды:\n"
+    "/start - Информация о боте\n"
+    "/help - Показать эту справку\n"
+    "/restart - Перезапустить диалог"
+)
+_RESTART_TEXT: Final[str] = "Диалог перезапущен. Вы можете задать новый вопрос."
+_NO_ANSWER_TEXT: Final[str] = "Извините, не удалось получить ответ."
+_API_ERROR_TEXT: Final[str] = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+_TIMEOUT_TEXT: Final[str] = "Извините, запрос занял слишком много времени. Пожалуйста, попробуйте позже."
+_ERROR_TEXT: Final[str] = "Извините, произошла ошибка. Пожалуйста, попробуйте позже."
+_ECHO_TEXT: Final[str] = "Пожалуйста, задайте ваш вопрос об исламских финансах."
+
 bot = None
+_session: aiohttp.ClientSession = None
+_redis = None
+_queue: asyncio.Queue = None
+_workers = []
+_inflight: dict[str, asyncio.Future] = {}
+_batcher = None
+
+
+@dataclass
+class ChatJob:
+    """A question waiting to be sent to the API by a chat worker."""
+    message: types.Message
+    chat_id: int
+    question: str
 
 def register_bot(bot_instance):
     global bot
@@ -20,6 +67,35 @@ def register_bot(bot_instance):
 
     asyncio.create_task(setup_bot_commands(bot))
 
+def register_session(session_instance):
+    global _session
+    _session = session_instance
+
+def get_session():
+    return _session
+
+def register_batcher(batcher_instance):
+    global _batcher
+    _batcher = batcher_instance
+
+async def close_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+def start_chat_workers(count=API_CONCURRENCY):
+    """Start the worker pool that performs API calls off the handler path."""
+    global _queue
+    # Bounded so a burst is refused instead of piling up in memory
+    _queue = asyncio.Queue(maxsize=count * API_QUEUE_PER_WORKER)
+    for _ in range(count):
+        _workers.append(asyncio.create_task(chat_worker(_queue)))
+
+async def stop_chat_workers():
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
 async def setup_bot_commands(bot_instance):
     commands = [
         BotCommand(command="start", description="Информация о боте"),
@@ -32,35 +108,18 @@ async def setup_bot_commands(bot_instance):
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
 
-    await message.answer(
-        "🌙 <b>Добро пожаловать в DinarAI!</b> 🌙\n\n"
-        "Я ваш персональный эксперт по исламским финансам, готовый помочь вам разобраться в:\n"
-        "• 🏦 Исламском банкинге\n"
-        "• 📊 Финансовых инструментах, соответствующих шариату\n"
-        "Просто задайте вопрос, и я предоставлю вам подробный ответ!.\n\n"
-        "<i>Ваш путь к этичным финансам начинается здесь!</i>",
-        parse_mode=ParseMode.HTML
-    )
+    await message.answer(_WELCOME_TEXT, parse_mode=ParseMode.HTML)
     await state.set_state(UserStates.waiting_for_question)
 
 
 async def cmd_help(message: types.Message):
-    await message.answer(
-        "Я могу ответить на ваши вопросы об исламских финансах.\n\n"
-        "Просто напишите ваш вопрос, и я постараюсь помочь.\n\n"
-        "Доступные команды:\n"
-        "/start - Информация о боте\n"
-        "/help - Показать эту справку\n"
-        "/restart - Перезапустить диалог"
-    )
+    await message.answer(_HELP_TEXT)
 
 
 async def cmd_restart(message: types.Message, state: FSMContext):
     await state.clear()
     
-    await message.answer(
-        "Диалог перезапущен. Вы можете задать новый вопрос."
-    )
+    await message.answer(_RESTART_TEXT)
     
     await state.set_state(UserStates.waiting_for_question)
 
@@ -68,68 +127,162 @@ async def cmd_restart(message: types.Message, state: FSMContext):
 async def process_question(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     question = message.text
-    processing_message = None
-    
+
+    cached = await get_cached_answer(_redis, question)
+    if cached is not None:
+        try:
+            await send_answer(message, question, cached["answer"], cached["sources"])
+        except Exception as e:
+            logging.error(f"Error sending cached answer: {e}")
+            await safe_send_message(message, _ERROR_TEXT)
+        return
+
+    try:
+        _queue.put_nowait(ChatJob(message, chat_id, question))
+    except asyncio.QueueFull:
+        logging.warning("Question queue is full, refusing question")
+        await safe_send_message(message, _API_ERROR_TEXT)
+
+
+async def chat_worker(queue: asyncio.Queue):
+    while True:
+        job = await queue.get()
+        try:
+            await answer_question(job)
+        except Exception as e:
+            logging.error(f"Chat worker failed to process job: {e}")
+        finally:
+            queue.task_done()
+
+
+async def post_chat(payload):
+    async with get_session().post(API_CHAT_URL, data=orjson.dumps(payload), headers=JSON_HEADERS) as response:
+        if response.status != 200:
+            return None
+        return orjson.loads(await response.read())
+
+
+async def request_answer(chat_id, question):
+    """Fetch (answer, sources) from the API, or None if it returned an error status."""
+    payload = {
+        "chat_id": chat_id,
+        "question": question
+    }
+
+    if _batcher is not None:
+        data = await _batcher.submit(payload)
+    else:
+        data = await post_chat(payload)
+    if data is None:
+        return None
+
+    raw_answer = data.get("answer")
+    sources = data.get("urls", [])
+    if raw_answer:
+        await cache_answer(_redis, question, raw_answer, sources)
+    else:
+        raw_answer = _NO_ANSWER_TEXT
+    return raw_answer, sources
+
+
+async def fetch_answer(chat_id, question):
+    """Return (answer, sources) from the cache or the API.
+
+    Identical questions arriving while an API call is in flight wait for
+    that call instead of starting their own.
+    """
+    cached = await get_cached_answer(_redis, question)
+    if cached is not None:
+        return cached["answer"], cached["sources"]
+
+    key = normalize_question(question)
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
     try:
-        processing_message = await safe_send_message(message, "Обрабатываю ваше сообщение...")
+        result = await request_answer(chat_id, question)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
     except Exception as e:
-        logging.error(f"Failed to send processing message: {e}")
-        return
-    
+        future.set_exception(e)
+        future.exception()  # Mark as retrieved in case nobody else is waiting
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        del _inflight[key]
+
+
+@functools.lru_cache(maxsize=2048)
+def render_source(source: str) -> str:
+    """Render a source URL as an HTML link; the same sources recur across answers."""
+    return f'<a href="{html.escape(source, quote=True)}">{html.escape(source)}</a>'
+
+
+def render_answer(raw_answer, sources):
+    """Build the HTML reply from an answer and its source URLs."""
+    answer = markdown_to_html(raw_answer)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Sources raw=%r type=%s", sources, type(sources).__name__)
+
+    parts = [answer, "\n\n"]
+
+    if sources:
+        parts.append("📚 <b>Источники:</b>\n")
+        for i, source in enumerate(sources, 1):
+            parts.append(f"{i}. {render_source(source)}\n")
+
+    return "".join(parts)
+
+
+async def send_answer(message, question, raw_answer, sources):
+    """Send a rendered answer; drop it from the cache if Telegram rejects it."""
     try:
-        payload = {
-            "chat_id": chat_id,
-            "question": question
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{API_HOST}/chat", 
-                json=payload, 
-                timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    answer = markdown_to_html(data.get("answer", "Извините, не удалось получить ответ."))
-                    sources = data.get("urls", [])
-                    logging.info(f"Sources (raw): {sources}")
-                    logging.info(f"Sources type: {type(sources)}")
-
-                    response_text = f"{answer}\n\n"
-
-                    if sources:
-                        response_text += "📚 <b>Источники:</b>\n"
-                        for i, source in enumerate(sources, 1):
-                            response_text += f"{i}. {markdown_to_html(source)}\n"
-
-                    if processing_message:
-                        await safe_delete_message(bot, processing_message.chat.id, processing_message.message_id)
-
-                    await safe_send_message(message, response_text, parse_mode=ParseMode.HTML)
-                else:
-                    if processing_message:
-                        await safe_delete_message(bot, processing_message.chat.id, processing_message.message_id)
-
-                    await safe_send_message(message, "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже.")
+        await safe_send_message(message, render_answer(raw_answer, sources), parse_mode=ParseMode.HTML)
+    except TelegramBadRequest:
+        await drop_cached_answer(_redis, question)
+        raise
+
+
+async def answer_question(job: ChatJob):
+    message = job.message
+    # Show "typing..." while this worker waits for the API
+    typing = asyncio.create_task(keep_typing(bot, job.chat_id))
+
+    try:
+        result = await fetch_answer(job.chat_id, job.question)
+        typing.cancel()
+        if result is None:
+            await safe_send_message(message, _API_ERROR_TEXT)
+            return
+
+        await send_answer(message, job.question, *result)
     except asyncio.TimeoutError:
         logging.error("API request timed out")
-        if processing_message:
-            await safe_delete_message(bot, processing_message.chat.id, processing_message.message_id)
-        await safe_send_message(message, "Извините, запрос занял слишком много времени. Пожалуйста, попробуйте позже.")
+        await safe_send_message(message, _TIMEOUT_TEXT)
     except Exception as e:
         logging.error(f"Error processing question: {e}")
-        if processing_message:
-            await safe_delete_message(bot, processing_message.chat.id, processing_message.message_id)
-        await safe_send_message(message, "Извините, произошла ошибка. Пожалуйста, попробуйте позже.")
+        await safe_send_message(message, _ERROR_TEXT)
+    finally:
+        typing.cancel()
 
 
 async def echo(message: types.Message, state: FSMContext):
-    await message.answer("Пожалуйста, задайте ваш вопрос об исламских финансах.")
+    await message.answer(_ECHO_TEXT)
+
 
+def register_handlers(dp, redis_client=None):
+    global _redis
+    _redis = redis_client
+    register_send_limiter(redis_client)
 
-def register_handlers(dp):
     dp.message.register(cmd_start, Command('start'))
     dp.message.register(cmd_help, Command('help'))
     dp.message.register(cmd_restart, Command('restart'))
-    dp.message.register(process_question, UserStates.waiting_for_question)
+    dp.message.register(process_question, UserStates.waiting_for_question, F.text)
     dp.message.register(echo)
\ No newline at end of file
@@ -1,15 +1,17 @@
-from flask import Flask, render_template
-from threading import Thread
+from aiohttp import web
 
-app = Flask(__name__)
+from config import PORT
 
-@app.route('/')
-def index():
-    return "Alive"
 
-def run():
-  app.run(host='0.0.0.0',port=8080)
+async def index(request):
+    return web.Response(text="Alive")
 
-def keep_alive():  
-    t = Thread(target=run)
-    t.start()
\ No newline at end of file
+async def keep_alive():
+    """Serve the health-check endpoint on the bot's event loop."""
+    app = web.Application()
+    app.add_routes([web.get('/', index)])
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    return runner
\ No newline at end of file
@@ -1,36 +1,94 @@
 import logging
 import asyncio
+import aiohttp
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.redis import RedisStorage
 
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
 from keep_alive import keep_alive
-from config import TG_BOT_API_KEY, REDIS_HOST, REDIS_PORT, REDIS_DB
-from handlers import register_handlers, register_bot
+from batcher import MicroBatcher
+from config import (
+    TG_BOT_API_KEY, REDIS_HOST, REDIS_PORT, REDIS_DB,
+    API_TIMEOUT, API_CONNECT_TIMEOUT, API_READ_TIMEOUT,
+    API_CHAT_BATCH_URL, API_BATCH_SIZE, API_BATCH_WAIT_MS,
+    API_CONCURRENCY, HTTP_POOL_LIMIT, HTTP_POOL_PER_HOST
+)
+from handlers import (
+    register_handlers, register_bot, register_session, register_batcher,
+    close_session, start_chat_workers, stop_chat_workers
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Start keep-alive thread
-keep_alive()
-
 async def main():
     """Initialize and start the bot."""
     # Initialize Redis storage
     storage = RedisStorage.from_url(f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}')
+    # Share the storage connection pool with application-level caches
+    redis_client = storage.redis
     
     # Initialize bot and dispatcher
     bot = Bot(token=TG_BOT_API_KEY)
     dp = Dispatcher(storage=storage)
     
+    # Initialize shared HTTP session for API requests. It is separate from
+    # the bot's own Telegram session, which start_polling closes on exit;
+    # this one is closed by the close_session shutdown hook.
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=API_TIMEOUT,
+            connect=API_CONNECT_TIMEOUT,
+            sock_connect=API_CONNECT_TIMEOUT,
+            sock_read=API_READ_TIMEOUT
+        )
+    )
+    register_session(session)
+    
     # Register bot instance with handlers
     register_bot(bot)
     
     # Register all handlers
-    register_handlers(dp)
+    register_handlers(dp, redis_client)
+    
+    # Start API workers; stop them before the HTTP session is closed.
+    # Never run more workers than the pool has connections to the API host
+    # (a per-host limit of 0 means unlimited).
+    workers = API_CONCURRENCY
+    if HTTP_POOL_PER_HOST > 0:
+        workers = min(workers, HTTP_POOL_PER_HOST)
+    start_chat_workers(workers)
+    dp.shutdown.register(stop_chat_workers)
+    
+    # Optionally batch API requests if the backend supports /chat_batch
+    if API_BATCH_SIZE > 1:
+        batcher = MicroBatcher(session, API_CHAT_BATCH_URL, API_BATCH_SIZE, API_BATCH_WAIT_MS)
+        batcher.start()
+        register_batcher(batcher)
+        dp.shutdown.register(batcher.stop)
+    dp.shutdown.register(close_session)
+    
+    # Start keep-alive server on the same event loop
+    keep_alive_runner = await keep_alive()
+    dp.shutdown.register(keep_alive_runner.cleanup)
     
     # Start polling
     logging.info("Starting bot")
     await dp.start_polling(bot, skip_updates=True)
 
 if __name__ == '__main__':
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
\ No newline at end of file
@@ -1,53 +1,355 @@
-import re
+import random
+import time
+import hashlib
 import logging
 import asyncio
-from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
-from aiogram.enums import ParseMode
+from collections import OrderedDict
+import orjson
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramBadRequest, TelegramNetworkError, TelegramServerError
+)
+from aiogram.enums import ParseMode, ChatAction
 
-from config import MAX_RETRIES, INITIAL_RETRY_DELAY
+from config import (
+    MAX_RETRIES, INITIAL_RETRY_DELAY, MAX_RETRY_DELAY, ANSWER_CACHE_TTL, LOCAL_CACHE_SIZE,
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL
+)
 
-async def safe_delete_message(bot, chat_id, message_id):
-    """Safely delete a message with proper error handling."""
-    try:
-        await bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except TelegramBadRequest as e:
-        if "message to delete not found" in str(e):
-            logging.warning(f"Message {message_id} already deleted or not found")
-        else:
-            logging.error(f"Error deleting message: {e}")
-    except Exception as e:
-        logging.error(f"Error deleting message: {e}")
+# Headers for request bodies pre-serialized with orjson
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Markdown headings as (prefix, opening tag, closing tag), longest prefix first
+_HEADINGS = (
+    ('### ', '<b><i>', '</i></b>'),  # H3 as bold italic
+    ('## ', '<b>', '</b>'),  # H2 as bold
+    ('# ', '<b><u>', '</u></b>'),  # H1 as bold underlined
+)
+
+
+class AsyncTokenBucket:
+    """Token bucket that makes callers wait until a token is available."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def try_acquire(self, tokens=1):
+        """Take tokens without waiting; False if none are free or others are waiting."""
+        if self._lock.locked():
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+
+_send_bucket = AsyncTokenBucket(rate=TELEGRAM_GLOBAL_RATE, capacity=TELEGRAM_GLOBAL_RATE)
+_last_chat_send = OrderedDict()  # chat_id -> last reserved slot, oldest update first
+_redis = None
+
+
+def register_send_limiter(redis_instance):
+    """Share per-chat send spacing through Redis across bot instances."""
+    global _redis
+    _redis = redis_instance
+
+
+async def _wait_chat_slot_local(chat_id):
+    now = time.monotonic()
+    # Forget chats whose last slot is over an interval old; they may send now anyway
+    while _last_chat_send:
+        oldest_chat, oldest_slot = next(iter(_last_chat_send.items()))
+        if oldest_slot + TELEGRAM_CHAT_INTERVAL > now:
+            break
+        del _last_chat_send[oldest_chat]
+
+    # Reserve the next free slot for this chat before sleeping
+    slot = max(now, _last_chat_send.get(chat_id, 0.0) + TELEGRAM_CHAT_INTERVAL)
+    _last_chat_send[chat_id] = slot
+    _last_chat_send.move_to_end(chat_id)
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+
+async def _wait_chat_slot_redis(chat_id):
+    key = f"tg:chat_slot:{chat_id}"
+    interval_ms = int(TELEGRAM_CHAT_INTERVAL * 1000)
+    # The key lives for one interval after a send; whoever sets it may send
+    while not await _redis.set(key, 1, nx=True, px=interval_ms):
+        ttl = await _redis.pttl(key)
+        await asyncio.sleep(max(ttl, 10) / 1000)
+
+
+async def wait_send_slot(chat_id):
+    """Wait until a message may be sent to chat_id without hitting Telegram limits.
+
+    The global token is taken first so that the per-chat slot, reserved
+    last, starts when the message is actually sent.
+    """
+    await _send_bucket.acquire(1)
+    if _redis is None:
+        await _wait_chat_slot_local(chat_id)
+    else:
+        try:
+            await _wait_chat_slot_redis(chat_id)
+        except Exception as e:
+            logging.warning(f"Redis send spacing unavailable, using local state: {e}")
+            await _wait_chat_slot_local(chat_id)
+
+
+async def keep_typing(bot, chat_id, interval=4):
+    """Show the typing indicator in a chat until cancelled.
+
+    Telegram clears the indicator after about five seconds or when the bot
+    sends a message, so it is refreshed every interval seconds. A refresh
+    is skipped when the global send bucket has no token to spare, so
+    messages never wait behind chat actions.
+    """
+    while True:
+        if _send_bucket.try_acquire(1):
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            except Exception as e:
+                logging.warning(f"Error sending chat action: {e}")
+        await asyncio.sleep(interval)
 
 
 async def safe_send_message(message_obj, text, parse_mode=None):
-    """Send a message with retry logic for rate limits and errors."""
+    """Send a message, retrying on rate limits and transient network errors."""
     retry_delay = INITIAL_RETRY_DELAY
     
     for attempt in range(MAX_RETRIES):
         try:
+            await wait_send_slot(message_obj.chat.id)
             return await message_obj.answer(text, parse_mode=parse_mode)
         except TelegramRetryAfter as e:
-            retry_after = e.retry_after
-            logging.warning(f"Rate limit hit. Waiting for {retry_after} seconds. Attempt {attempt+1}/{MAX_RETRIES}")
+            # Small jitter so handlers limited at the same moment don't retry together
+            retry_after = e.retry_after + random.uniform(0, 0.25)
+            logging.warning(f"Rate limit hit. Waiting for {retry_after:.2f} seconds. Attempt {attempt+1}/{MAX_RETRIES}")
             await asyncio.sleep(retry_after)
-        except Exception as e:
+        except TelegramBadRequest as e:
+            # Malformed request (e.g. broken HTML) - retrying won't help
+            logging.error(f"Telegram rejected message: {e}")
+            raise
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
             logging.error(f"Error sending message: {e}")
             if attempt == MAX_RETRIES - 1:  # Last attempt
                 raise
-            await asyncio.sleep(retry_delay)
-            retry_delay *= 2  # Exponential backoff
+            delay = min(retry_delay * (1 + random.random() * 0.5), MAX_RETRY_DELAY)
+            await asyncio.sleep(delay)
+            retry_delay *= 2  # Exponential backoff with jitter
+
+
+class TTLCache:
+    """Small LRU cache whose entries expire ttl seconds after being set."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+
+_local_answers = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so trivially different spellings share cache entries."""
+    return " ".join(question.lower().split())
+
+
+def answer_cache_key(question: str) -> str:
+    """Build the Redis key for a cached answer to the given question."""
+    return f"ans:{hashlib.sha1(normalize_question(question).encode()).hexdigest()}"
+
+
+async def get_cached_answer(redis, question):
+    """Return the cached {"answer", "sources"} dict for a question, or None.
+
+    The in-process cache is checked first, so hot questions skip Redis too.
+    Answers copied from Redis expire locally when the Redis key does.
+    """
+    key = answer_cache_key(question)
+    cached = _local_answers.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            raw, ttl_ms = await pipe.get(key).pttl(key).execute()
+    except Exception as e:
+        logging.warning(f"Answer cache lookup failed: {e}")
+        return None
+    if not raw:
+        return None
+
+    cached = orjson.loads(raw)
+    # PTTL is -1 for a key without an expiry (keep the default TTL) and -2 if
+    # the key expired between the two commands
+    ttl = None if ttl_ms == -1 else max(ttl_ms, 0) / 1000
+    _local_answers.set(key, cached, ttl)
+    return cached
+
+
+async def cache_answer(redis, question, answer, sources):
+    """Store an API answer so repeated questions skip the upstream call."""
+    key = answer_cache_key(question)
+    cached = {"answer": answer, "sources": sources}
+    _local_answers.set(key, cached)
+    try:
+        await redis.set(key, orjson.dumps(cached), ex=ANSWER_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"Failed to cache answer: {e}")
+
+
+async def drop_cached_answer(redis, question):
+    """Forget a cached answer, e.g. one Telegram refused to deliver."""
+    key = answer_cache_key(question)
+    _local_answers.pop(key)
+    try:
+        await redis.delete(key)
+    except Exception as e:
+        logging.warning(f"Failed to drop cached answer: {e}")
+
+
+def _find_close(line: str, delim: str, pos: int) -> int:
+    """Find the delim closing a span, skipping `code` spans.
+
+    When closing an italic span, complete **bold** pairs are skipped too.
+    """
+    while True:
+        found = line.find(delim, pos)
+        if found == -1:
+            return -1
+        tick = line.find('`', pos, found)
+        if tick != -1:
+            tick_close = line.find('`', tick + 1)
+            if tick_close != -1:
+                pos = tick_close + 1
+                continue
+        if delim == '*' and line.startswith('**', found):
+            bold_close = _find_close(line, '**', found + 2)
+            if bold_close != -1:
+                pos = bold_close + 2
+                continue
+        return found
+
+
+def _inline_to_html(line: str, out: list) -> None:
+    """Append line to out with **bold**, *italic* and `code` converted to HTML."""
+    pos = 0
+    star = line.find('*')
+    tick = line.find('`')
+    while star != -1 or tick != -1:
+        if star != -1 and star < pos:
+            star = line.find('*', pos)
+        if tick != -1 and tick < pos:
+            tick = line.find('`', pos)
+        if star == -1 and tick == -1:
+            break
+
+        start = star if tick == -1 or (star != -1 and star < tick) else tick
+        out.append(line[pos:start])
+        if start == tick:
+            close = line.find('`', start + 1)
+            if close != -1:
+                out.append('<code>')
+                out.append(line[start + 1:close])
+                out.append('</code>')
+                pos = close + 1
+                continue
+        else:
+            if line.startswith('**', start):
+                close = _find_close(line, '**', start + 2)
+                if close != -1:
+                    out.append('<b>')
+                    _inline_to_html(line[start + 2:close], out)
+                    out.append('</b>')
+                    pos = close + 2
+                    continue
+            if line.startswith('**', start):
+                close = start + 1  # Unclosed ** is an empty italic, as before
+            else:
+                close = _find_close(line, '*', start + 1)
+            if close != -1:
+                out.append('<i>')
+                _inline_to_html(line[start + 1:close], out)
+                out.append('</i>')
+                pos = close + 1
+                continue
+
+        # Unmatched delimiter is kept as literal text
+        out.append(line[start])
+        pos = start + 1
+    out.append(line[pos:])
 
 
 def markdown_to_html(text: str) -> str:
-    """Convert markdown formatting to HTML for Telegram."""
-    text = re.sub(r'^### (.*?)$', r'<b><i>\1</i></b>', text, flags=re.MULTILINE)  # H3 as bold italic
-    text = re.sub(r'^## (.*?)$', r'<b>\1</b>', text, flags=re.MULTILINE)  # H2 as bold
-    text = re.sub(r'^# (.*?)$', r'<b><u>\1</u></b>', text, flags=re.MULTILINE)  # H1 as bold underlined
-    
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    
-    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
-    
-    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
-    
-    return text
\ No newline at end of file
+    """Convert markdown formatting to HTML for Telegram in a single pass.
+
+    **bold** pairs take precedence over a single *, so italic spans never
+    close inside a bold pair:
+
+    >>> markdown_to_html('* **Мудараба** — партнёрство')
+    '* <b>Мудараба</b> — партнёрство'
+    >>> markdown_to_html('*очень **важно** для*')
+    '<i>очень <b>важно</b> для</i>'
+    >>> markdown_to_html('*см. `a*b` выше*')
+    '<i>см. <code>a*b</code> выше</i>'
+    """
+    if '*' not in text and '`' not in text and '#' not in text:
+        return text
+
+    out = []
+    for line in text.split('\n'):
+        if line.startswith('#'):
+            for prefix, opening, closing in _HEADINGS:
+                if line.startswith(prefix):
+                    out.append(opening)
+                    _inline_to_html(line[len(prefix):], out)
+                    out.append(closing)
+                    break
+            else:
+                _inline_to_html(line, out)
+        else:
+            _inline_to_html(line, out)
+        out.append('\n')
+    out.pop()
+    return ''.join(out)
\ No newline at end of file